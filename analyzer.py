@@ -0,0 +1,99 @@
+"""gmail-alerting-app/analyzer.py
+
+Reglas de detección y análisis de un mensaje ya descargado. Este módulo no
+depende de la API de Gmail ni de Slack: recibe cadenas y devuelve la lista
+de alertas, de modo que `main.py` solo se ocupa de la E/S.
+
+Notas:
+ - Ajustar `KEYWORDS`, `WHITELIST_DOMAINS` y `DANGEROUS_EXTENSIONS`
+     según necesidades.
+ - Está anotado por completo para poder compilarlo con `mypyc`
+     (`mypyc analyzer.py`). Si existe la extensión compilada, Python la
+     importa en lugar de este fichero; si no, se usa esta versión en Python
+     puro sin cambiar nada en `main.py`.
+"""
+
+from email.utils import getaddresses  # Extraer las direcciones de la cabecera From
+import ahocorasick  # type: ignore  # Autómata Aho-Corasick para buscar todas las KEYWORDS en una sola pasada
+
+
+# Reglas de detección (puedes parametrizarlas o cargarlas desde .env)
+KEYWORDS: list[str] = ['confidencial', 'contraseña']
+WHITELIST_DOMAINS: list[str] = ['@empresa.com', '@amazon.com']
+DANGEROUS_EXTENSIONS: list[str] = ['.zip', '.exe', '.js', '.bat']
+
+# Autómata construido una sola vez al importar: localiza todas las
+# `KEYWORDS` recorriendo el texto una única vez, en lugar de una búsqueda
+# por palabra clave.
+KEYWORDS_AUTOMATON = ahocorasick.Automaton()
+for _word in KEYWORDS:
+    KEYWORDS_AUTOMATON.add_word(_word.lower(), _word)
+KEYWORDS_AUTOMATON.make_automaton()
+
+# Dominios de `WHITELIST_DOMAINS` sin la `@` y en minúsculas: comprobar el
+# dominio del remitente es una búsqueda O(1) en el conjunto, sin importar
+# cuántos dominios haya en la lista blanca
+WHITELIST_DOMAIN_SET: frozenset[str] = frozenset(d.lstrip('@').lower() for d in WHITELIST_DOMAINS)
+
+# Extensiones peligrosas sin el punto y en minúsculas: basta con extraer la
+# extensión del fichero y comprobar su pertenencia al conjunto en O(1)
+DANGEROUS_EXTENSIONS_SET: frozenset[str] = frozenset(e.lstrip('.').lower() for e in DANGEROUS_EXTENSIONS)
+
+
+def is_whitelisted(sender: str) -> bool:
+    """Indicar si todas las direcciones de `sender` son de `WHITELIST_DOMAINS`."""
+    addresses = getaddresses([sender])
+    if not addresses:
+        return False
+    for _, address in addresses:
+        _, at, domain = address.rpartition('@')
+        if not at or domain.lower() not in WHITELIST_DOMAIN_SET:
+            return False
+    return True
+
+
+def analyze_message(subject: str, sender: str, snippet: str, filenames: list[str]) -> list[tuple[str, str]]:
+    """Evaluar un mensaje y devolver las alertas detectadas.
+
+    Parámetros:
+      - subject: asunto del correo
+      - sender: remitente (cabecera From)
+      - snippet: fragmento de texto del mensaje
+      - filenames: nombres de fichero de todas las partes del mensaje
+
+    Retorna:
+      Una lista de tuplas `(motivo, detalle)`, p. ej.
+      `('Palabra detectada', 'confidencial')`. Vacía si todas las
+      direcciones del remitente son de `WHITELIST_DOMAINS` o no se detecta
+      nada.
+    """
+    alerts: list[tuple[str, str]] = []
+
+    # Excluir dominios de confianza para reducir falsos positivos. Solo se
+    # miran las direcciones reales (el nombre visible puede contener
+    # cualquier texto) y From puede listar varias: se excluye el mensaje
+    # solo si hay al menos una y todas son de dominios de confianza. Una
+    # cabecera mal formada produce entradas vacías o sin dominio válido,
+    # que no cuentan como de confianza.
+    if is_whitelisted(sender):
+        return alerts
+
+    # Buscar palabras clave en asunto y snippet en una sola pasada,
+    # alertando una vez por palabra y parando cuando ya se han visto todas
+    if KEYWORDS:
+        found: set[str] = set()
+        for _, word in KEYWORDS_AUTOMATON.iter(f"{subject.lower()}\n{snippet.lower()}"):
+            if word in found:
+                continue
+            found.add(word)
+            alerts.append(("Palabra detectada", word))
+            if len(found) == len(KEYWORDS):
+                break
+
+    # Analizar adjuntos de forma simple (comprobar nombre de fichero)
+    for filename in filenames:
+        _, dot, ext = filename.rpartition('.')
+        if dot and ext.lower() in DANGEROUS_EXTENSIONS_SET:
+            alerts.append(("Adjunto peligroso", filename))
+
+    return alerts
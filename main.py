@@ -16,21 +16,32 @@ Flujo general:
 Notas:
  - `token.json` se genera en el primer arranque tras autorizar la
      aplicación en el navegador.
- - Ajustar `KEYWORDS`, `WHITELIST_DOMAINS` y `DANGEROUS_EXTENSIONS`
-     según necesidades.
+ - Las reglas de detección (`KEYWORDS`, `WHITELIST_DOMAINS`,
+     `DANGEROUS_EXTENSIONS`) y el análisis de cada mensaje están en
+     `analyzer.py`.
 """
 
 import os  # Acceso a variables de entorno y operaciones con el sistema de archivos
 import sys  # Módulo para interactuar con el sistema, usado para salir del programa en caso de error crítico.
-import json  # Leer/escribir JSON (p. ej. token.json)
+import orjson  # (De)serialización JSON nativa (Rust): respuestas de Gmail, Slack y ficheros de estado
+import queue  # Cola de alertas pendientes de enviar a Slack
+import threading  # Hilo en segundo plano que envía las alertas a Slack
+import time  # Espera entre ciclos en modo de sondeo continuo
 import requests  # Enviar HTTP requests (usado para Webhook de Slack)
+from requests.adapters import HTTPAdapter  # Pool de conexiones y reintentos para la sesión HTTP
+from urllib3.util.retry import Retry  # Política de reintentos ante errores transitorios
 from google.auth.transport.requests import Request  # Utilidad para refrescar tokens OAuth
 from google.oauth2.credentials import Credentials  # Gestiona credenciales OAuth (token.json)
 from google_auth_oauthlib.flow import InstalledAppFlow  # Flujo interactivo de OAuth (abre navegador)
 from googleapiclient.discovery import build  # Construir cliente de la API de Gmail
+from googleapiclient.errors import HttpError  # Errores HTTP devueltos por la API de Gmail
+from googleapiclient.model import JsonModel  # Modelo que decodifica las respuestas de la API
 from datetime import datetime  # Marcas de tiempo o parseo si se necesita más tarde
 import logging  # Sistema de logging para registrar alertas en archivo/console
+import logging.handlers  # QueueHandler/QueueListener para escribir logs fuera del hilo principal
+import atexit  # Detener el listener de logs (vaciando la cola) al salir
 from dotenv import load_dotenv  # Cargar variables desde .env
+from analyzer import analyze_message  # Reglas de detección (compilable con mypyc)
 
 
 # Carga las variables desde un archivo .env si existe (útil en desarrollo)
@@ -41,52 +52,156 @@ load_dotenv()
 #   existe, las alertas solo se registran en `alertas.txt`.
 WEBHOOK_URL = os.getenv('WEBHOOK_URL')
 GMAIL_MAX_RESULTS = int(os.getenv('GMAIL_MAX_RESULTS', 10))
+# - `POLL_INTERVAL`: segundos entre análisis en modo continuo. Con 0 (por
+#   defecto) el script analiza una sola vez y termina.
+POLL_INTERVAL = int(os.getenv('POLL_INTERVAL', 0))
+
+# Número de peticiones `get()` agrupadas en cada petición batch. Gmail
+# admite hasta 100, pero recomienda no superar 50 para evitar rate limiting.
+GMAIL_BATCH_SIZE = 50
+
+# Fichero donde se guardan los IDs de mensajes ya analizados para no
+# volver a descargarlos en ejecuciones posteriores (lista ordenada del más
+# antiguo al más reciente, con como mucho `GMAIL_MAX_RESULTS` entradas más
+# las que fallaron en el último ciclo).
+SEEN_FILE = 'seen.json'
+
+# Fichero con el último `historyId` procesado. A partir de él,
+# `history().list()` devuelve solo los mensajes añadidos desde entonces.
+HISTORY_FILE = 'history.json'
+
+# Niveles de anidamiento MIME (multipart dentro de multipart) que cubre la
+# máscara de `messages().get()`; los reenvíos y firmas suelen añadir dos o
+# tres niveles. Los mensajes más profundos se descargan completos.
+GMAIL_PARTS_DEPTH = 6
+
+# Máscara de respuesta parcial para `messages().get()`: Gmail solo devuelve
+# las cabeceras, el snippet y los nombres de fichero de la parte raíz y de
+# las partes anidadas, sin el cuerpo codificado en base64 que el análisis
+# nunca lee. En el último nivel se pide además `parts/partId`: si aparece,
+# el árbol sigue más abajo y la respuesta está incompleta.
+_parts_fields = 'parts(filename,parts/partId)'
+for _ in range(GMAIL_PARTS_DEPTH - 1):
+    _parts_fields = f'parts(filename,{_parts_fields})'
+GMAIL_MESSAGE_FIELDS = f'snippet,payload(filename,headers(name,value),{_parts_fields})'
+
+# Máscara para `messages().list()`: de cada mensaje solo hace falta el ID
+GMAIL_LIST_FIELDS = 'messages/id,nextPageToken'
+
+# Tamaño máximo de página admitido por `messages().list()`
+GMAIL_LIST_PAGE_SIZE = 500
+
+# Máscara para `history().list()`: ID de cada registro, IDs y etiquetas de
+# los mensajes añadidos y el `historyId` actual del buzón
+GMAIL_HISTORY_FIELDS = 'history(id,messagesAdded/message(id,labelIds)),nextPageToken,historyId'
+
+# Etiquetas que `messages().list()` excluye por defecto (`includeSpamTrash`);
+# `history().list()` no tiene ese filtro y se aplica a mano
+EXCLUDED_LABELS = frozenset({'SPAM', 'TRASH'})
 
 # OAuth scopes requeridos: solo lectura de Gmail en este POC
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 
-# Reglas de detección (puedes parametrizarlas o cargarlas desde .env)
-KEYWORDS = ['confidencial', 'contraseña']
-WHITELIST_DOMAINS = ['@empresa.com', '@amazon.com']
-DANGEROUS_EXTENSIONS = ['.zip', '.exe', '.js', '.bat']
-
 
 # Configuración básica del sistema de logs
 # Permitir ajustar el nivel de logs mediante la variable de entorno `LOG_LEVEL`
 level_name = os.getenv('LOG_LEVEL', 'INFO').upper()
 level = getattr(logging, level_name, logging.INFO)
 
-logging.basicConfig(
-    level=level,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
-    handlers=[
-        logging.FileHandler("alertas.txt", encoding='utf-8'), # Escribir en archivo
-        logging.StreamHandler() # Mostrar en consola
-    ]
-)
+# Los registros se encolan con un `QueueHandler`; un `QueueListener` en
+# segundo plano los escribe en archivo y consola, de modo que ni el
+# análisis ni el hilo de Slack se bloquean con la E/S de disco.
+log_formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+file_handler = logging.FileHandler("alertas.txt", encoding='utf-8') # Escribir en archivo
+file_handler.setFormatter(log_formatter)
+stream_handler = logging.StreamHandler() # Mostrar en consola
+stream_handler.setFormatter(log_formatter)
+
+LOG_QUEUE = queue.Queue()
+log_listener = logging.handlers.QueueListener(LOG_QUEUE, file_handler, stream_handler)
+
+root_logger = logging.getLogger()
+root_logger.setLevel(level)
+root_logger.addHandler(logging.handlers.QueueHandler(LOG_QUEUE))
+
+log_listener.start()
+# `stop` procesa los registros pendientes antes de terminar
+atexit.register(log_listener.stop)
 
 logger = logging.getLogger("GmailAlerts")
 
+# Sesión HTTP reutilizada para todos los envíos a Slack: mantiene abierta la
+# conexión HTTPS (keep-alive) y evita un handshake TLS por alerta. Los
+# errores transitorios (429/5xx) se reintentan con espera exponencial.
+SESSION = requests.Session()
+SESSION.headers.update({'Content-type': 'application/json'})
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=4,
+    max_retries=Retry(
+        total=2,
+        backoff_factor=0.3,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({'POST'}),
+        raise_on_status=False,
+    ),
+))
+
+# Cola acotada de alertas pendientes de enviar a Slack. El análisis solo
+# encola el texto y un hilo en segundo plano hace los `POST`, de modo que
+# la latencia de Slack no frena la lectura de correos.
+ALERT_QUEUE = queue.Queue(maxsize=256)
+
+# Máximo de alertas agrupadas en un mismo mensaje de Slack cuando hay
+# varias acumuladas en la cola
+SLACK_MAX_BATCH = 10
+
+class OrjsonModel(JsonModel):
+    """`JsonModel` que decodifica las respuestas de la API con `orjson`.
+
+    Se pasa a `build(..., model=...)` y se aplica también a cada respuesta
+    de las peticiones batch. Gmail no usa `dataWrapper`, así que basta con
+    sustituir la decodificación.
+    """
+
+    def deserialize(self, content):
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            # Respuesta que no es JSON: se mantiene el comportamiento original
+            return super().deserialize(content)
+
+# Credenciales y cliente de Gmail cacheados en el proceso: en modo continuo
+# (`POLL_INTERVAL`) se reutilizan entre ciclos sin releer `token.json`
+_CREDS = None
+_SERVICE = None
+
 def get_service():
     """Autentica y devuelve un cliente de la API de Gmail.
 
     Comportamiento:
-    - Si existe `token.json`, lo usa para crear las credenciales.
+    - Si ya hay un cliente creado en este proceso con credenciales
+      válidas, lo reutiliza sin tocar disco.
+    - Si no, y existe `token.json`, lo usa para crear las credenciales.
     - Si el token ha caducado y hay `refresh_token`, lo refresca.
     - Si no hay credenciales válidas, inicia `InstalledAppFlow` y abre
-      el navegador para que el usuario autorice la app. Tras la
-      autorización guarda `token.json` para futuros arranques.
+      el navegador para que el usuario autorice la app.
+    - `token.json` solo se reescribe si el token de acceso ha cambiado.
 
     Retorna:
       Un objeto `Resource` creado por `googleapiclient.discovery.build`
       listo para hacer llamadas `service.users().messages()...`.
     """
-    creds = None
-    if os.path.exists('token.json'):
+    global _CREDS, _SERVICE
+    if _SERVICE is not None and _CREDS.valid:
+        return _SERVICE
+
+    creds = _CREDS
+    if creds is None and os.path.exists('token.json'):
         # `token.json` contiene access/refresh tokens generados previamente
         creds = Credentials.from_authorized_user_file('token.json', SCOPES)
     if not creds or not creds.valid:
+        previous_token = creds.token if creds else None
         if creds and creds.expired and creds.refresh_token:
             # Intentar refrescar automáticamente si es posible
             creds.refresh(Request())
@@ -99,11 +214,103 @@ def get_service():
                 logger.critical("Error: El archivo 'credentials.json' no se encontró.")
                 logger.critical("Por favor, descarga tus credenciales de OAuth 2.0 desde Google Cloud Console y colócalas en la raíz del proyecto.")
                 sys.exit(1)
-        # Guardar credenciales para usos posteriores
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
-    # Construir el cliente de la API de Gmail
-    return build('gmail', 'v1', credentials=creds, cache_discovery=False)
+        # Guardar credenciales para usos posteriores (solo si han cambiado)
+        if creds.token != previous_token:
+            with open('token.json', 'w') as token:
+                token.write(creds.to_json())
+    # Construir el cliente de la API de Gmail a partir del documento de
+    # discovery incluido en la librería (`static_discovery`), sin descargarlo
+    # de `discovery.googleapis.com` en cada arranque. Si solo se refrescó el
+    # token, el cliente existente ya usa el mismo objeto de credenciales.
+    if _SERVICE is None or creds is not _CREDS:
+        _SERVICE = build('gmail', 'v1', credentials=creds, cache_discovery=False, static_discovery=True, model=OrjsonModel())
+    _CREDS = creds
+    return _SERVICE
+
+def load_seen_ids():
+    """Cargar los IDs de mensajes analizados en ejecuciones anteriores.
+
+    Retorna una lista ordenada del más antiguo al más reciente, vacía si
+    `SEEN_FILE` no existe o no se puede leer.
+    """
+    if not os.path.exists(SEEN_FILE):
+        return []
+    try:
+        with open(SEEN_FILE, 'rb') as f:
+            return list(orjson.loads(f.read()))
+    except (OSError, ValueError, TypeError) as e:
+        logger.warning(f"No se pudo leer '{SEEN_FILE}', se analizarán todos los mensajes: {e}")
+        return []
+
+def write_json_atomic(path, data):
+    """Escribir `data` como JSON en `path` de forma atómica.
+
+    Se escribe primero en un fichero temporal y luego se sustituye con
+    `os.replace`, de modo que una interrupción no deja el fichero a medias.
+    """
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps(data))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.error(f"No se pudo guardar '{path}': {e}")
+
+def save_seen_ids(ids):
+    """Guardar en `SEEN_FILE` la lista ordenada de IDs analizados."""
+    write_json_atomic(SEEN_FILE, ids)
+
+def load_history_id():
+    """Cargar el último `historyId` procesado, o `None` si no hay ninguno."""
+    if not os.path.exists(HISTORY_FILE):
+        return None
+    try:
+        with open(HISTORY_FILE, 'rb') as f:
+            return orjson.loads(f.read())['historyId']
+    except (OSError, ValueError, TypeError, KeyError) as e:
+        logger.warning(f"No se pudo leer '{HISTORY_FILE}', se analizarán los últimos mensajes: {e}")
+        return None
+
+def save_history_id(history_id):
+    """Guardar en `HISTORY_FILE` el `historyId` hasta el que se ha analizado."""
+    write_json_atomic(HISTORY_FILE, {'historyId': history_id})
+
+def send_to_slack(mensaje_slack):
+    """Enviar un mensaje al Webhook de Slack registrando cualquier fallo."""
+    try:
+        response = SESSION.post(
+            WEBHOOK_URL,
+            data=orjson.dumps(mensaje_slack),
+            timeout=5
+        )
+        if response.status_code != 200:
+            logger.error(f"Error en Slack: {response.status_code} - {response.text}")
+    except Exception as e:
+        # No interrumpe la ejecución principal, solo registra el fallo
+        logger.error(f"Fallo en envío de Webhook: {e}")
+
+def slack_worker():
+    """Consumir `ALERT_QUEUE` y enviar las alertas a Slack.
+
+    Si hay varias alertas acumuladas, se agrupan (hasta `SLACK_MAX_BATCH`)
+    en un único mensaje para reducir el número de peticiones.
+    """
+    while True:
+        texts = [ALERT_QUEUE.get()]
+        while len(texts) < SLACK_MAX_BATCH:
+            try:
+                texts.append(ALERT_QUEUE.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            send_to_slack({"text": "\n\n".join(texts)})
+        finally:
+            for _ in texts:
+                ALERT_QUEUE.task_done()
+
+# Hilo daemon que vacía la cola; al terminar se espera con `ALERT_QUEUE.join()`
+if WEBHOOK_URL:
+    threading.Thread(target=slack_worker, name='slack-worker', daemon=True).start()
 
 def log_alert(subject, sender, reason):
     """Registrar y (opcionalmente) notificar una alerta.
@@ -116,7 +323,8 @@ def log_alert(subject, sender, reason):
     Acciones realizadas:
       1. Formatea un mensaje para Slack (clave `text`).
       2. Registra la alerta en el logger (se escribe en `alertas.txt`).
-      3. Si `WEBHOOK_URL` está configurada, hace un `POST` a Slack.
+      3. Si `WEBHOOK_URL` está configurada, encola el mensaje para que
+         `slack_worker` lo envíe a Slack en segundo plano.
     """
 
     detection_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -130,66 +338,277 @@ def log_alert(subject, sender, reason):
     log_local = f"{reason} | Remitente: {sender} | Asunto: {subject}"
     logger.warning(log_local)
 
-    # Enviar a Slack si se configuró el webhook
+    # Encolar para Slack si se configuró el webhook (sin bloquear el análisis)
     if WEBHOOK_URL:
         try:
-            response = requests.post(
-                WEBHOOK_URL,
-                json=mensaje_slack,
-                headers={'Content-type': 'application/json'},
-                timeout=5
-            )
-            if response.status_code != 200:
-                logger.error(f"Error en Slack: {response.status_code} - {response.text}")
-        except Exception as e:
-            # No interrumpe la ejecución principal, solo registra el fallo
-            logger.error(f"Fallo en envío de Webhook: {e}")
+            ALERT_QUEUE.put_nowait(mensaje_slack["text"])
+        except queue.Full:
+            logger.error("Cola de Slack llena: la alerta solo se ha registrado localmente.")
     else:
         logger.info("Aviso: No se envió notificación a Slack (WEBHOOK_URL no configurada).")
 
-def analyze_emails():
-        """Leer y analizar mensajes recientes de la cuenta autorizada.
+def iter_filenames(payload):
+        """Generar los nombres de fichero de todas las partes del mensaje.
 
-        - Obtiene una lista de mensajes (configurable con `GMAIL_MAX_RESULTS`).
-        - Para cada mensaje descarga el detalle, extrae `Subject`, `From`
-            y `snippet`.
-        - Excluye remitentes cuyos dominios estén en `WHITELIST_DOMAINS`.
-        - Busca `KEYWORDS` en el `snippet` y en el asunto; si encuentra
-            coincidencias llama a `log_alert`.
-        - Recorre las partes del payload para verificar si hay archivos
-            cuya extensión esté en `DANGEROUS_EXTENSIONS` y registra alertas.
+        Recorre el árbol MIME completo desde la parte raíz (un mensaje de
+        una sola parte puede ser él mismo el adjunto) con una pila
+        explícita, en el orden en que aparecen las partes.
         """
-        service = get_service()
+        stack = [payload]
+        while stack:
+                part = stack.pop()
+                filename = part.get('filename')
+                if filename:
+                        yield filename
+                stack.extend(reversed(part.get('parts', [])))
+
+def mime_tree_truncated(payload):
+        """Indicar si el árbol MIME supera los `GMAIL_PARTS_DEPTH` niveles.
+
+        Con `GMAIL_MESSAGE_FIELDS`, las partes del último nivel solo traen
+        `parts` si hay más anidamiento del que cubre la máscara; en ese caso
+        faltan nombres de fichero y hay que descargar el mensaje completo.
+        """
+        stack = [(payload, 0)]
+        while stack:
+                part, level = stack.pop()
+                children = part.get('parts', [])
+                if children and level == GMAIL_PARTS_DEPTH:
+                        return True
+                stack.extend((child, level + 1) for child in children)
+        return False
+
+def process_message(msg_data):
+        """Evaluar un mensaje ya descargado y registrar las alertas detectadas.
+
+        - Extrae `Subject`, `From`, `snippet` y los nombres de fichero de
+            todas las partes del payload (incluidas las anidadas).
+        - Delega la evaluación en `analyzer.analyze_message` y llama a
+            `log_alert` por cada alerta devuelta.
+        """
+        # Indexar las cabeceras por nombre (sin distinguir mayúsculas) en un
+        # solo recorrido; `reversed` conserva la primera aparición si se repiten
+        headers = {h['name'].lower(): h['value'] for h in reversed(msg_data['payload']['headers'])}
 
-        # 1. Leer la lista de los últimos correos
-        results = service.users().messages().list(userId='me', maxResults=GMAIL_MAX_RESULTS).execute()
-        messages = results.get('messages', [])
+        # Extraer campos útiles (con valores por defecto si no existen)
+        subject = headers.get('subject', "Sin Asunto")
+        sender = headers.get('from', "Desconocido")
+        snippet = msg_data.get('snippet', '')
+        filenames = list(iter_filenames(msg_data['payload']))
 
-        for msg in messages:
-                # 2. Obtener el contenido completo de cada mensaje por su ID
-                msg_data = service.users().messages().get(userId='me', id=msg['id']).execute()
-                headers = msg_data['payload']['headers']
+        for reason, detail in analyze_message(subject, sender, snippet, filenames):
+                log_alert(subject, sender, f"{reason}: {detail}")
 
-                # 3. Extraer campos útiles (con valores por defecto si no existen)
-                subject = next((h['value'] for h in headers if h['name'] == 'Subject'), "Sin Asunto")
-                sender = next((h['value'] for h in headers if h['name'] == 'From'), "Desconocido")
-                snippet = msg_data.get('snippet', '').lower()
+def iter_message_ids(service, limit):
+        """Generar los IDs de los `limit` mensajes más recientes.
 
-                # Excluir dominios de confianza para reducir falsos positivos
-                if any(domain in sender for domain in WHITELIST_DOMAINS):
-                        continue
+        Recorre las páginas de `messages().list()` siguiendo `nextPageToken`
+        bajo demanda, de modo que nunca se mantiene la lista completa en
+        memoria y `limit` puede superar el tamaño máximo de página.
+        """
+        page_token = None
+        remaining = limit
+        while remaining > 0:
+                results = service.users().messages().list(
+                        userId='me',
+                        maxResults=min(remaining, GMAIL_LIST_PAGE_SIZE),
+                        pageToken=page_token,
+                        fields=GMAIL_LIST_FIELDS,
+                ).execute()
+                page = results.get('messages', [])
+                for msg in page:
+                        yield msg['id']
+                remaining -= len(page)
+                page_token = results.get('nextPageToken')
+                if not page or not page_token:
+                        break
+
+def iter_history_message_ids(service, start_history_id, cursor, limit):
+        """Generar los IDs de los mensajes añadidos desde `start_history_id`.
+
+        Recorre las páginas de `history().list()` y deja en
+        `cursor['historyId']` hasta dónde se ha llegado. Omite los mensajes
+        con etiquetas de `EXCLUDED_LABELS`, igual que `messages().list()`.
+
+        Genera como mucho `limit` IDs (se corta al terminar un registro del
+        historial). Si quedan más, `cursor['historyId']` apunta al último
+        registro generado y el resto se analiza en la siguiente ejecución;
+        si no, apunta al `historyId` actual del buzón.
+
+        Lanza `HttpError` 404 si `start_history_id` es demasiado antiguo.
+        """
+        page_token = None
+        count = 0
+        last_record_id = start_history_id
+        while True:
+                results = service.users().history().list(
+                        userId='me',
+                        startHistoryId=start_history_id,
+                        historyTypes=['messageAdded'],
+                        maxResults=GMAIL_LIST_PAGE_SIZE,
+                        pageToken=page_token,
+                        fields=GMAIL_HISTORY_FIELDS,
+                ).execute()
+                for record in results.get('history', []):
+                        if count >= limit:
+                                cursor['historyId'] = last_record_id
+                                logger.info(f"Más de {limit} mensajes nuevos: el resto se analizará en la siguiente ejecución.")
+                                return
+                        for added in record.get('messagesAdded', []):
+                                message = added['message']
+                                if EXCLUDED_LABELS.isdisjoint(message.get('labelIds', [])):
+                                        count += 1
+                                        yield message['id']
+                        last_record_id = record['id']
+                cursor['historyId'] = results.get('historyId', start_history_id)
+                page_token = results.get('nextPageToken')
+                if not page_token:
+                        break
+
+def fetch_messages(service, ids, callback, fields=GMAIL_MESSAGE_FIELDS):
+        """Descargar los mensajes `ids` en una única petición batch.
+
+        `callback(request_id, response, exception)` se invoca por mensaje.
+        Con `fields=None` se descarga el mensaje completo, sin máscara.
+        """
+        batch = service.new_batch_http_request(callback=callback)
+        for msg_id in ids:
+                request = service.users().messages().get(userId='me', id=msg_id, fields=fields)
+                batch.add(request, request_id=msg_id)
+        batch.execute()
 
-                # Buscar palabras clave en snippet y asunto
-                for word in KEYWORDS:
-                        if word in snippet or word in subject.lower():
-                                log_alert(subject, sender, f"Palabra detectada: {word}")
+def analyze_emails():
+        """Leer y analizar mensajes recientes de la cuenta autorizada.
 
-                # Analizar adjuntos de forma simple (comprobar nombre de fichero)
-                parts = msg_data['payload'].get('parts', [])
-                for part in parts:
-                        filename = part.get('filename', '')
-                        if any(filename.lower().endswith(ext) for ext in DANGEROUS_EXTENSIONS):
-                                log_alert(subject, sender, f"Adjunto peligroso: {filename}")
+        - Si hay un `historyId` guardado en `HISTORY_FILE`, pide a Gmail
+            solo los mensajes añadidos desde entonces (`history().list()`),
+            como mucho `GMAIL_MAX_RESULTS` por ejecución; en reposo cuesta
+            una única llamada.
+        - Si no (primera ejecución o `historyId` caducado), recorre los IDs
+            de los últimos mensajes (configurable con `GMAIL_MAX_RESULTS`)
+            con `iter_message_ids`, sin materializar la lista completa.
+        - Descarta los mensajes ya analizados en ejecuciones anteriores
+            (registrados en `SEEN_FILE`).
+        - Descarga el detalle de los mensajes mediante peticiones batch de
+            la API de Gmail (hasta `GMAIL_BATCH_SIZE` por petición HTTP) en
+            lugar de una llamada `get()` por mensaje.
+        - Cada respuesta se evalúa con `process_message`.
+        """
+        service = get_service()
+        seen_ids = load_seen_ids()
+        seen = set(seen_ids)
+        listed_ids = set()
+        processed = []
+        failed = set()
+        deep = []
+
+        def _on_msg(request_id, response, exception, full=False):
+                # Callback del batch: se invoca una vez por mensaje
+                if exception is not None:
+                        if isinstance(exception, HttpError) and exception.resp.status == 404:
+                                # El mensaje se borró después de aparecer en el listado
+                                logger.info(f"El mensaje {request_id} ya no existe.")
+                        else:
+                                logger.error(f"Error al obtener el mensaje {request_id}: {exception}")
+                                failed.add(request_id)
+                        return
+                if not isinstance(response, dict):
+                        # Cuerpo que no es JSON (p. ej. un proxy intermedio): se reintenta
+                        logger.error(f"Respuesta no válida para el mensaje {request_id}.")
+                        failed.add(request_id)
+                        return
+                # Un error aquí no debe abortar `batch.execute()`: se perdería el
+                # registro de lo ya analizado y se repetirían sus alertas
+                try:
+                        if not full and mime_tree_truncated(response['payload']):
+                                # La máscara no cubre todo el árbol: descargarlo completo después
+                                deep.append(request_id)
+                                return
+                        process_message(response)
+                except Exception:
+                        # Mensaje con formato inesperado: no se reintenta, porque
+                        # fallaría igual en cada ciclo y bloquearía el `historyId`
+                        logger.exception(f"Error al analizar el mensaje {request_id}")
+                processed.append(request_id)
+
+        # 1. Obtener los IDs a analizar: cambios desde el último `historyId`
+        #    o, si no lo hay, la ventana de los últimos correos
+        cursor = {}
+        message_ids = None
+        start_history_id = load_history_id()
+        if start_history_id is not None:
+                try:
+                        message_ids = list(iter_history_message_ids(service, start_history_id, cursor, GMAIL_MAX_RESULTS))
+                except HttpError as e:
+                        if e.resp.status != 404:
+                                raise
+                        logger.warning("El historyId guardado ha caducado: se analizarán los últimos mensajes.")
+        window_scan = message_ids is None
+        if window_scan:
+                # Anotar el `historyId` antes de listar para no perder mensajes
+                # que lleguen mientras se analiza
+                profile = service.users().getProfile(userId='me', fields='historyId').execute()
+                cursor['historyId'] = profile['historyId']
+                message_ids = iter_message_ids(service, GMAIL_MAX_RESULTS)
+
+        # 2. Omitir los ya analizados y descargar el resto en lotes de
+        #    `GMAIL_BATCH_SIZE`
+        pending = []
+        for msg_id in message_ids:
+                # El historial puede repetir un mismo ID y el batch no admite
+                # dos peticiones con el mismo `request_id`
+                if msg_id in listed_ids:
+                        continue
+                listed_ids.add(msg_id)
+                if msg_id in seen:
+                        continue
+                pending.append(msg_id)
+                if len(pending) == GMAIL_BATCH_SIZE:
+                        fetch_messages(service, pending, _on_msg)
+                        pending = []
+        if pending:
+                fetch_messages(service, pending, _on_msg)
+
+        # Mensajes con más de `GMAIL_PARTS_DEPTH` niveles MIME: descargarlos
+        # sin máscara (también en lotes) para no dejar adjuntos profundos sin
+        # revisar
+        def _on_full_msg(request_id, response, exception):
+                _on_msg(request_id, response, exception, full=True)
+
+        for start in range(0, len(deep), GMAIL_BATCH_SIZE):
+                fetch_messages(service, deep[start:start + GMAIL_BATCH_SIZE], _on_full_msg, fields=None)
+
+        # 3. Registrar los IDs analizados (sin escribir si no hay ninguno
+        #    nuevo); los que fallaron se reintentan en la siguiente ejecución.
+        #    Basta con conservar los `GMAIL_MAX_RESULTS` más recientes: es lo
+        #    que cubriría una vuelta a la ventana. Se reserva además sitio por
+        #    cada fallo, porque el ciclo siguiente repite el mismo intervalo
+        #    del historial y sus mensajes ya analizados deben seguir en `seen`.
+        if processed:
+                if window_scan:
+                        seen_ids = [msg_id for msg_id in seen_ids if msg_id in listed_ids]
+                keep = GMAIL_MAX_RESULTS + len(failed)
+                save_seen_ids((seen_ids + processed)[-keep:])
+
+        # 4. Avanzar el `historyId` solo si no hubo fallos; si los hubo, el
+        #    siguiente ciclo repite el intervalo y `seen` evita duplicar alertas
+        if not failed:
+                save_history_id(cursor['historyId'])
 
 if __name__ == '__main__':
-    analyze_emails()
\ No newline at end of file
+    try:
+        if POLL_INTERVAL <= 0:
+            analyze_emails()
+        else:
+            # Modo continuo: un fallo puntual (red, API) no detiene el proceso
+            while True:
+                try:
+                    analyze_emails()
+                except Exception as e:
+                    logger.error(f"Fallo en el ciclo de análisis: {e}")
+                time.sleep(POLL_INTERVAL)
+    except KeyboardInterrupt:
+        logger.info("Ejecución interrumpida por el usuario.")
+    finally:
+        # Esperar a que se envíen las alertas pendientes antes de salir
+        ALERT_QUEUE.join()
\ No newline at end of file